@@ -4,15 +4,83 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import asyncio
 import functools
-from typing import Optional
+import heapq
+import itertools
+import string
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Optional
 import discord
 from discord.ext import commands
 from dismob import log, filehelper
 from dismob.event import Event
 import aiosqlite
 import random
-import datetime
+
+READER_COUNT: int = 4  # number of read-only connections to the database
+MESSAGE_SEPARATOR: str = "\x1f"  # char(31), used to concatenate the messages in a single column
+GREET_FLUSH_INTERVAL: float = 2.0  # seconds between two writes of the buffered greet counts
+ACTIVE_JOIN_MESSAGES_LIMIT: int = 10000  # max number of join messages tracked per guild, the oldest are forgotten first
+LIST_PAGE_SIZE: int = 25  # number of messages displayed per page by the list-message commands
+MESSAGE_CACHE_LIMIT: int = 500  # above this number of messages a guild's list is not cached, SQLite picks the message instead
+
+MessageTemplate = Callable[[discord.Member], str]  # compiled message, returns the text for the given member
+
+# Placeholders available in the join/leave messages
+MESSAGE_FIELDS: dict[str, Callable[[discord.Member], str]] = {
+    "member": lambda member: member.display_name,
+    "server": lambda member: member.guild.name,
+    "mention": lambda member: member.mention,
+}
+
+def compile_message(message: str) -> MessageTemplate:
+    """Compile a join/leave message so that formatting it does not parse it again.
+
+    Args:
+        message: The message as written by the user, with `{member}`, `{server}` and `{mention}` placeholders
+    Returns:
+        A function building the text of the message for a member
+    """
+    message = message.replace('\\n', '\n')
+    def fallback(member: discord.Member) -> str:
+        return message.format(**{key: get(member) for key, get in MESSAGE_FIELDS.items()})
+
+    parts: list = []  # literal strings and placeholder getters
+    try:
+        parsed = list(string.Formatter().parse(message))
+    except ValueError:
+        return fallback  # malformed, str.format will raise when sending like before
+    for literal, field, spec, conversion in parsed:
+        if field is not None and (spec or conversion or field not in MESSAGE_FIELDS):
+            # Uncommon template, let str.format handle it (and raise for unknown placeholders)
+            return fallback
+        if literal:
+            parts.append(literal)
+        if field is not None:
+            parts.append(MESSAGE_FIELDS[field])
+    return lambda member: "".join(part if isinstance(part, str) else part(member) for part in parts)
+
+def db_ready_only(func):
+    # functools.wraps is required, discord.py reads the command parameters from the wrapped function
+    @functools.wraps(func)
+    async def wrapper(self, ctx: discord.Interaction, *args, **kwargs):
+        if not self.db_ready:
+            await log.client(ctx, "Database is not ready yet. Please try again in a few seconds.")
+            return
+        return await func(self, ctx, *args, **kwargs)
+    return wrapper
+
+async def delete_message_at(msg: discord.Message, deadline: float):
+    """Delete a message once the given time.monotonic() deadline is reached."""
+    try:
+        await asyncio.sleep(deadline - time.monotonic())
+        await msg.delete()
+    except discord.NotFound:
+        pass
+    except Exception as e:
+        log.error(f"Failed to auto-delete message: {e}")
 
 async def setup(bot: commands.Bot):
     log.info("Module `welcome` setup")
@@ -28,14 +96,42 @@ class Welcome(commands.Cog):
         self.bot: commands.Bot = bot
         self.db_path: str = "db/welcome.db"
         self.db_ready: bool = False
+        self._writer: aiosqlite.Connection = None
+        self._writer_lock: asyncio.Lock = asyncio.Lock()  # SQLite serializes writes anyway
+        self._readers: list[aiosqlite.Connection] = []
+        self._reader_cycle = None
+        self._config_cache: dict[int, Optional[aiosqlite.Row]] = {}  # {guild_id: welcome_config row or None}
+        self._cache_generation: dict[int, int] = {}  # {guild_id: number of cache invalidations}, to drop loads that raced with a write
+        self._join_msgs: dict[int, Optional[list[MessageTemplate]]] = {}  # {guild_id: [join message] or None if too many to be cached}
+        self._leave_msgs: dict[int, Optional[list[MessageTemplate]]] = {}  # {guild_id: [leave message] or None if too many to be cached}
+        self._pending_greets: Counter = Counter()  # {(guild_id, greeter_id): count not yet written to the database}
+        self._inflight_greets: Counter = Counter()  # {(guild_id, greeter_id): count being written, not committed yet}
+        self._greet_flushes: int = 0  # number of finished flushes
+        self._greet_flusher: Optional[asyncio.Task] = None
         def template(interaction: discord.Interaction, greeted_member: discord.Member) -> None: pass
         self.on_greeting: Event = Event(template)
         self.bot.loop.create_task(self.init_db())
-        self._active_join_messages = {}  # {guild_id: {member_id: (message, delete_task)}}
+        self._active_join_messages: dict[int, OrderedDict[int, discord.Message]] = {}  # {guild_id: {member_id: message}}, until the message is deleted
+        # Messages to auto-delete, all handled by a single worker task
+        self._delete_heap: list[list] = []  # [[monotonic deadline, sequence, message or None if cancelled, member_id]]
+        self._delete_entries: dict[int, list] = {}  # {message_id: heap entry}, to cancel a scheduled deletion
+        self._delete_sequence = itertools.count()  # tie-breaker, messages cannot be compared
+        self._delete_event: asyncio.Event = asyncio.Event()
+        self._delete_worker_task: asyncio.Task = self.bot.loop.create_task(self._delete_worker())
 
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
+        # Long-lived connections are shared by every handler, this avoids spawning a new
+        # aiosqlite thread and re-opening the database files on each call.
+        # A single writer and a few read-only connections, so reads never wait on the writer under WAL
+        self._writer = await aiosqlite.connect(self.db_path)
+        self._writer.row_factory = aiosqlite.Row
+        await self._writer.execute("PRAGMA journal_mode=WAL")
+        await self._writer.execute("PRAGMA synchronous=NORMAL")
+        await self._writer.execute("PRAGMA temp_store=memory")
+        await self._writer.execute("PRAGMA cache_size=-64000")
+        async with self._writer_lock:
+            db = self._writer
+            await db.executescript("""
                 CREATE TABLE IF NOT EXISTS welcome_config (
                     guild_id INTEGER PRIMARY KEY,
                     join_enabled BOOLEAN DEFAULT 1,
@@ -46,62 +142,257 @@ class Welcome(commands.Cog):
                     leave_title TEXT DEFAULT 'Goodbye',
                     join_duration INTEGER DEFAULT 0,   -- duration in seconds, 0 or negative means do not delete
                     leave_duration INTEGER DEFAULT 0   -- duration in seconds, 0 or negative means do not delete
-                )
-            """)
-            await db.execute("""
+                );
+
                 CREATE TABLE IF NOT EXISTS welcome_join_messages (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     guild_id INTEGER,
                     message TEXT NOT NULL,
                     FOREIGN KEY (guild_id) REFERENCES welcome_config(guild_id) ON DELETE CASCADE
-                )
-            """)
-            await db.execute("""
+                );
+                CREATE INDEX IF NOT EXISTS idx_join_msgs_guild ON welcome_join_messages(guild_id);
+
                 CREATE TABLE IF NOT EXISTS welcome_leave_messages (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     guild_id INTEGER,
                     message TEXT NOT NULL,
                     FOREIGN KEY (guild_id) REFERENCES welcome_config(guild_id) ON DELETE CASCADE
-                )
-            """)
+                );
+                CREATE INDEX IF NOT EXISTS idx_leave_msgs_guild ON welcome_leave_messages(guild_id);
 
-            await db.execute("""
                 CREATE TABLE IF NOT EXISTS welcome_greet_counts (
                     guild_id INTEGER,
                     greeter_id INTEGER,
                     count INTEGER DEFAULT 0,
                     PRIMARY KEY (guild_id, greeter_id)
-                )
+                );
             """)
             await db.commit()
-            self.db_ready = True
-            log.info("Welcome database initialized")
+
+        # Readers are opened once the tables exist, a read-only connection cannot create the file
+        for _ in range(READER_COUNT):
+            reader = await aiosqlite.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            reader.row_factory = aiosqlite.Row
+            await reader.execute("PRAGMA temp_store=memory")
+            await reader.execute("PRAGMA cache_size=-64000")
+            self._readers.append(reader)
+        self._reader_cycle = itertools.cycle(self._readers)
+        self._greet_flusher = self.bot.loop.create_task(self._flush_greets_loop())
+
+        self.db_ready = True
+        log.info("Welcome database initialized")
+
+    async def cog_unload(self):
+        self.db_ready = False
+        self._delete_worker_task.cancel()
+        # Hand the pending deletions off to standalone tasks, so they still happen once the cog is gone
+        for deadline, _, msg, _ in self._delete_heap:
+            if msg is not None:
+                self.bot.loop.create_task(delete_message_at(msg, deadline))
+        self._delete_heap = []
+        self._delete_entries = {}
+        if self._greet_flusher is not None:
+            self._greet_flusher.cancel()
+            self._greet_flusher = None
+        try:
+            if self._writer is not None:
+                await self.flush_greet_counts()
+        finally:
+            for reader in self._readers:
+                await reader.close()
+            self._readers = []
+            self._reader_cycle = None
+            if self._writer is not None:
+                await self._writer.close()
+                self._writer = None
+
+    async def _reader(self) -> aiosqlite.Connection:
+        """Get the next read-only connection from the pool (round-robin)."""
+        return next(self._reader_cycle)
+
+    async def _get_config(self, guild_id: int) -> Optional[aiosqlite.Row]:
+        """Get the welcome config of a guild, from the cache if possible.
+
+        On a cache miss the join and leave messages are fetched in the same query,
+        so a cold guild costs a single round trip to the database.
+        The cache entry is invalidated by the settings commands.
+        Returns:
+            The config row, or None if the guild has no config
+        """
+        if guild_id in self._config_cache:
+            return self._config_cache[guild_id]
+
+        generation = self._cache_generation.get(guild_id, 0)
+        db = await self._reader()
+        async with db.execute("""
+            SELECT c.join_channel_id, c.join_enabled, c.join_title, c.join_duration, c.leave_channel_id, c.leave_enabled, c.leave_title, c.leave_duration,
+                (SELECT group_concat(message, char(31)) FROM (SELECT message FROM welcome_join_messages WHERE guild_id = c.guild_id LIMIT ?)) AS join_messages,
+                (SELECT group_concat(message, char(31)) FROM (SELECT message FROM welcome_leave_messages WHERE guild_id = c.guild_id LIMIT ?)) AS leave_messages
+            FROM welcome_config c
+            WHERE c.guild_id = ?
+        """, (MESSAGE_CACHE_LIMIT + 1, MESSAGE_CACHE_LIMIT + 1, guild_id)) as cursor:
+            row = await cursor.fetchone()
+        if self._cache_generation.get(guild_id, 0) != generation:
+            return row  # config or messages invalidated while loading, the row may be stale so it is not cached
+        self._config_cache[guild_id] = row
+        if row:
+            self._join_msgs[guild_id] = self._cacheable_messages(row["join_messages"].split(MESSAGE_SEPARATOR) if row["join_messages"] else [])
+            self._leave_msgs[guild_id] = self._cacheable_messages(row["leave_messages"].split(MESSAGE_SEPARATOR) if row["leave_messages"] else [])
+        return row
+
+    def _invalidate_config(self, guild_id: int):
+        """Drop the cached config of a guild, and any load of it still in flight."""
+        self._cache_generation[guild_id] = self._cache_generation.get(guild_id, 0) + 1
+        self._config_cache.pop(guild_id, None)
+
+    def _invalidate_messages(self, cache: dict[int, Optional[list[MessageTemplate]]], guild_id: int):
+        """Drop the cached join or leave messages of a guild, and any load of them still in flight.
+
+        The generation counter is shared with the config, which also loads the messages on a cache miss.
+        """
+        self._cache_generation[guild_id] = self._cache_generation.get(guild_id, 0) + 1
+        cache.pop(guild_id, None)
+
+    @staticmethod
+    def _cacheable_messages(messages: list[str]) -> Optional[list[MessageTemplate]]:
+        """Return the compiled messages to store in a message cache, or None if there are too many of them."""
+        return [compile_message(message) for message in messages] if len(messages) <= MESSAGE_CACHE_LIMIT else None
+
+    async def _pick_message(self, cache: dict[int, Optional[list[MessageTemplate]]], table: str, guild_id: int) -> Optional[MessageTemplate]:
+        """Pick a random join or leave message of a guild, from the given cache if possible.
+
+        Guilds with more than MESSAGE_CACHE_LIMIT messages are not cached, SQLite picks the message for them.
+        The cache entry is invalidated by the add/remove message commands.
+        Returns:
+            The message, or None if the guild has no message
+        """
+        if guild_id in cache:
+            messages = cache[guild_id]
+        else:
+            generation = self._cache_generation.get(guild_id, 0)
+            db = await self._reader()
+            async with db.execute(f"""
+                SELECT message FROM {table}
+                WHERE guild_id = ?
+                LIMIT ?
+            """, (guild_id, MESSAGE_CACHE_LIMIT + 1)) as cursor:
+                messages = self._cacheable_messages([r["message"] for r in await cursor.fetchall()])
+            # Not cached if invalidated while loading, the list may be stale
+            if self._cache_generation.get(guild_id, 0) == generation:
+                cache[guild_id] = messages
+
+        if messages is not None:
+            return random.choice(messages) if messages else None
+
+        db = await self._reader()
+        async with db.execute(f"""
+            SELECT message FROM {table}
+            WHERE guild_id = ?
+            ORDER BY RANDOM() LIMIT 1
+        """, (guild_id,)) as cursor:
+            row = await cursor.fetchone()
+        return compile_message(row["message"]) if row else None
 
     async def increment_greet_count(self, guild_id: int, greeter_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                INSERT INTO welcome_greet_counts (guild_id, greeter_id, count)
-                VALUES (?, ?, 1)
-                ON CONFLICT(guild_id, greeter_id)
-                DO UPDATE SET count = count + 1
-            """, (guild_id, greeter_id))
-            await db.commit()
+        # Buffered, the counts are written in a single transaction by flush_greet_counts
+        self._pending_greets[(guild_id, greeter_id)] += 1
+
+    async def flush_greet_counts(self):
+        """Write the buffered greet counts to the database."""
+        if not self._pending_greets:
+            return
+        pending, self._pending_greets = self._pending_greets, Counter()
+        self._inflight_greets.update(pending)
+        try:
+            async with self._writer_lock:
+                db = self._writer
+                await db.executemany("""
+                    INSERT INTO welcome_greet_counts (guild_id, greeter_id, count)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(guild_id, greeter_id)
+                    DO UPDATE SET count = count + excluded.count
+                """, [(guild_id, greeter_id, count) for (guild_id, greeter_id), count in pending.items()])
+                await db.commit()
+        except Exception:
+            # Keep the counts so they are written on the next flush
+            self._pending_greets.update(pending)
+            raise
+        finally:
+            self._inflight_greets.subtract(pending)
+            self._inflight_greets = +self._inflight_greets  # drop the keys down to zero
+            self._greet_flushes += 1
+
+    async def _flush_greets_loop(self):
+        while True:
+            await asyncio.sleep(GREET_FLUSH_INTERVAL)
+            try:
+                await self.flush_greet_counts()
+            except Exception as e:
+                log.error(f"Failed to write greet counts: {e}")
 
     async def get_greet_count(self, guild_id: int, greeter_id: int) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+        key = (guild_id, greeter_id)
+        while True:
+            flushes = self._greet_flushes
+            db = await self._reader()
             async with db.execute("""
                 SELECT count FROM welcome_greet_counts
                 WHERE guild_id = ? AND greeter_id = ?
             """, (guild_id, greeter_id)) as cursor:
                 row = await cursor.fetchone()
-                return row[0] if row else 0
+            # A flush ended during the read, the row may or may not include its counts
+            if flushes == self._greet_flushes:
+                break
+        # Add the greetings not written (or not committed) to the database yet
+        return (row["count"] if row else 0) + self._pending_greets[key] + self._inflight_greets[key]
+
+    async def _delete_worker(self):
+        """Delete the scheduled messages once their deadline is reached."""
+        while True:
+            if not self._delete_heap:
+                self._delete_event.clear()
+                await self._delete_event.wait()
+                continue
+
+            delay = self._delete_heap[0][0] - time.monotonic()
+            if delay > 0:
+                # Wake up earlier if a message with a closer deadline is scheduled meanwhile
+                self._delete_event.clear()
+                try:
+                    await asyncio.wait_for(self._delete_event.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
 
-    async def send_formatted_message(self, channel: discord.TextChannel, title: str, message: str, member: discord.Member, color: discord.Color, view = None, delete_after: Optional[int] = None) -> Optional[discord.Message]:
+            _, _, msg, member_id = heapq.heappop(self._delete_heap)
+            if msg is None:
+                continue  # cancelled
+            del self._delete_entries[msg.id]
+            try:
+                # Shielded so that unloading the cog does not abort a deletion already started
+                await asyncio.shield(msg.delete())
+            except discord.NotFound:
+                pass  # already deleted by someone else
+            except Exception as e:
+                log.error(f"Failed to auto-delete message: {e}")
+            finally:
+                # Stop tracking the join message, unless the member joined again since
+                guild_msgs = self._active_join_messages.get(msg.guild.id)
+                if guild_msgs and guild_msgs.get(member_id) is msg:
+                    del guild_msgs[member_id]
+
+    def _cancel_delete(self, msg: discord.Message):
+        """Cancel the scheduled deletion of a message, if any."""
+        entry = self._delete_entries.pop(msg.id, None)
+        if entry is not None:
+            entry[2] = None  # left in the heap, skipped by the worker
+
+    async def send_formatted_message(self, channel: discord.TextChannel, title: str, message: MessageTemplate, member: discord.Member, color: discord.Color, view = None, delete_after: Optional[int] = None) -> Optional[discord.Message]:
         """Send a formatted embed message to the specified channel.
 
         Args:
             channel: The channel to send the message to
-            message: The message template to format
+            message: The compiled message template, see compile_message
             member: The member that triggered the event
             color: The color of the embed
             delete_after: Duration in seconds to delete the message, or None/<=0 to not delete
@@ -109,43 +400,28 @@ class Welcome(commands.Cog):
             The sent message, or None if failed
         """
         try:
-            data: dict = {
-                "member": member.display_name,
-                "server": member.guild.name,
-                "mention": member.mention
-            }
+            # Read once, reused for the author and thumbnail
+            display_name = member.display_name
+            avatar_url = member.display_avatar.url
 
-            msg = message.format(**data).replace('\\n', '\n')
+            msg = message(member)
             embed = discord.Embed(
                 #title=msg,
                 description=f"## {msg}",
                 color=color
             )
-            #embed.set_thumbnail(url=member.display_avatar.url)
-            embed.set_author(name=member.display_name, icon_url=member.display_avatar.url)
+            #embed.set_thumbnail(url=avatar_url)
+            embed.set_author(name=display_name, icon_url=avatar_url)
             sent_msg: discord.Message = await channel.send(embed=embed, view=view)
             if delete_after and delete_after > 0:
-                async def delete_later(msg: discord.Message, delay):
-                    try:
-                        await discord.utils.sleep_until(discord.utils.utcnow() + datetime.timedelta(seconds=delay))
-                        await msg.delete()
-                    except Exception as e:
-                        log.error(f"Failed to auto-delete message: {e}")
-                task = self.bot.loop.create_task(delete_later(sent_msg, delete_after))
-                return sent_msg, task
-            return sent_msg, None
+                entry = [time.monotonic() + delete_after, next(self._delete_sequence), sent_msg, member.id]
+                self._delete_entries[sent_msg.id] = entry
+                heapq.heappush(self._delete_heap, entry)
+                self._delete_event.set()
+            return sent_msg
         except Exception as e:
             log.error(f"Error sending formatted message: {e}")
-            return None, None
-
-    def db_ready_only(func):
-        @functools.wraps(func)
-        async def wrapper(self, ctx: discord.Interaction, *args, **kwargs):
-            if not self.db_ready:
-                await log.client(ctx, "Database is not ready yet. Please try again in a few seconds.")
-                return
-            return await func(self, ctx, *args, **kwargs)
-        return wrapper
+            return None
 
     #####                     #####
     #           events            #
@@ -157,57 +433,50 @@ class Welcome(commands.Cog):
             return
         channel = None
         enabled = False
-        messages = []
+        message = None
         title = None
         join_duration = 0
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute("""
-                    SELECT join_channel_id, join_enabled, join_title, join_duration FROM welcome_config
-                    WHERE guild_id = ?
-                """, (member.guild.id,)) as cursor:
-                    row = await cursor.fetchone()
-                    if row:
-                        if row[0] is not None:
-                            channel = member.guild.get_channel(row[0])
-                        if row[1] is not None:
-                            enabled = row[1]
-                        if row[2]:
-                            title = row[2]
-                        if row[3] is not None:
-                            join_duration = row[3]
-
-                if not enabled:
-                    return
-
-                if not channel:
-                    log.warning(f"Join channel not found for guild {member.guild.id}. Please set it using the `/welcome join set` command.")
-                    return
-
-                # Get all join messages for this guild
-                async with db.execute("""
-                    SELECT message FROM welcome_join_messages
-                    WHERE guild_id = ?
-                """, (member.guild.id,)) as cursor:
-                    messages = [r[0] async for r in cursor]
+            row = await self._get_config(member.guild.id)
+            if row:
+                if row["join_channel_id"] is not None:
+                    channel = member.guild.get_channel(row["join_channel_id"])
+                if row["join_enabled"] is not None:
+                    enabled = row["join_enabled"]
+                if row["join_title"]:
+                    title = row["join_title"]
+                if row["join_duration"] is not None:
+                    join_duration = row["join_duration"]
+
+            if not enabled:
+                return
+
+            if not channel:
+                log.warning(f"Join channel not found for guild {member.guild.id}. Please set it using the `/welcome join set` command.")
+                return
+
+            # Pick one of the join messages of this guild
+            message = await self._pick_message(self._join_msgs, "welcome_join_messages", member.guild.id)
         except Exception as e:
             log.error(f"Database error in on_member_join: {e}")
             return
 
-        if not messages:
+        if not message:
             log.warning(f"No join messages configured for guild {member.guild.id}. Please set them using the `/welcome join add-message` command.")
             return
 
-        message = random.choice(messages)
-
         view = discord.ui.View(timeout=None)
         view.add_item(WelcomeButton(self, member))
-        sent_msg, delete_task = await self.send_formatted_message(channel, title, message, member, discord.Color.green(), view=view, delete_after=join_duration)
+        sent_msg = await self.send_formatted_message(channel, title, message, member, discord.Color.green(), view=view, delete_after=join_duration)
         # Track the join message for possible early deletion
         if sent_msg and join_duration and join_duration > 0:
             if member.guild.id not in self._active_join_messages:
-                self._active_join_messages[member.guild.id] = {}
-            self._active_join_messages[member.guild.id][member.id] = (sent_msg, delete_task)
+                self._active_join_messages[member.guild.id] = OrderedDict()
+            guild_msgs = self._active_join_messages[member.guild.id]
+            guild_msgs[member.id] = sent_msg
+            guild_msgs.move_to_end(member.id)
+            if len(guild_msgs) > ACTIVE_JOIN_MESSAGES_LIMIT:
+                guild_msgs.popitem(last=False)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member) -> None:
@@ -216,59 +485,47 @@ class Welcome(commands.Cog):
         # If the member had a join message pending deletion, delete it now
         guild_msgs = self._active_join_messages.get(member.guild.id)
         if guild_msgs and member.id in guild_msgs:
-            msg, task = guild_msgs.pop(member.id)
+            msg = guild_msgs.pop(member.id)
+            self._cancel_delete(msg)
             try:
                 try:
                     await msg.delete()
                 except discord.NotFound:
                     pass
-                if task:
-                    task.cancel()
             except Exception as e:
                 log.error(f"Failed to delete join message for leaving member: {e}")
 
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute("""
-                    SELECT leave_channel_id, leave_enabled, leave_title, leave_duration FROM welcome_config
-                    WHERE guild_id = ?
-                """, (member.guild.id,)) as cursor:
-                    row = await cursor.fetchone()
-
-                channel = None
-                enabled = False
-                title = None
-                leave_duration = 0
-                if row:
-                    if row[0] is not None:
-                        channel = member.guild.get_channel(row[0])
-                    if row[1] is not None:
-                        enabled = row[1]
-                    if row[2]:
-                        title = row[2]
-                    if row[3] is not None:
-                        leave_duration = row[3]
-
-                if not enabled:
-                    return
-
-                if not channel:
-                    log.warning(f"Leave channel not found for guild {member.guild.id}. Please set it using the `/welcome leave set` command.")
-                    return
-
-                # Get all leave messages for this guild
-                async with db.execute("""
-                    SELECT message FROM welcome_leave_messages
-                    WHERE guild_id = ?
-                """, (member.guild.id,)) as cursor:
-                    messages = [r[0] async for r in cursor]
+            row = await self._get_config(member.guild.id)
+
+            channel = None
+            enabled = False
+            title = None
+            leave_duration = 0
+            if row:
+                if row["leave_channel_id"] is not None:
+                    channel = member.guild.get_channel(row["leave_channel_id"])
+                if row["leave_enabled"] is not None:
+                    enabled = row["leave_enabled"]
+                if row["leave_title"]:
+                    title = row["leave_title"]
+                if row["leave_duration"] is not None:
+                    leave_duration = row["leave_duration"]
+
+            if not enabled:
+                return
 
-                if not messages:
-                    log.warning(f"No leave messages configured for guild {member.guild.id}. Please set them using the `/welcome leave add-message` command.")
-                    return
+            if not channel:
+                log.warning(f"Leave channel not found for guild {member.guild.id}. Please set it using the `/welcome leave set` command.")
+                return
 
-                message = random.choice(messages)
-                await self.send_formatted_message(channel, title, message, member, discord.Color.red(), delete_after=leave_duration)
+            # Pick one of the leave messages of this guild
+            message = await self._pick_message(self._leave_msgs, "welcome_leave_messages", member.guild.id)
+
+            if not message:
+                log.warning(f"No leave messages configured for guild {member.guild.id}. Please set them using the `/welcome leave add-message` command.")
+                return
+            await self.send_formatted_message(channel, title, message, member, discord.Color.red(), delete_after=leave_duration)
         except Exception as e:
             log.error(f"Database error in on_member_remove: {e}")
 
@@ -298,40 +555,31 @@ class Welcome(commands.Cog):
     @db_ready_only
     async def set_join_config(self, ctx: discord.Interaction, channel: Optional[discord.TextChannel] = None, title: Optional[str] = None, enable: Optional[bool] = None, duration: Optional[int] = None) -> None:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute("""
-                    SELECT join_channel_id, join_title, join_enabled, join_duration FROM welcome_config
-                    WHERE guild_id = ?
-                """, (ctx.guild.id,)) as cursor:
-                    row = await cursor.fetchone()
-
-                if channel is None and title is None and enable is None and duration is None:
-                    if row:
-                        channel_id, title, enabled, join_duration = row
-                        channel_mention = f"<#{channel_id}>" if channel_id else "None"
-                        await log.client(ctx, f"Current join config: Channel: {channel_mention}, Title: {title}, Enabled: {enabled}, Duration: {join_duration}s")
-                    else:
-                        await log.client(ctx, "No join config found for this server.")
+            if channel is None and title is None and enable is None and duration is None:
+                row = await self._get_config(ctx.guild.id)
+                if row:
+                    channel_mention = f"<#{row['join_channel_id']}>" if row["join_channel_id"] else "None"
+                    await log.client(ctx, f"Current join config: Channel: {channel_mention}, Title: {row['join_title']}, Enabled: {row['join_enabled']}, Duration: {row['join_duration']}s")
                 else:
-                    if row:
-                        old_channel_id, old_title, old_enabled, old_duration = row
-                    else:
-                        old_channel_id = None
-                        old_title = "Welcome"
-                        old_enabled = True
-                        old_duration = 0
-
-                    channel_id = channel.id if channel else old_channel_id
-                    new_title = title if title is not None else old_title
-                    new_enable = enable if enable is not None else old_enabled
-                    new_duration = duration if duration is not None else old_duration
-                    await db.execute("""
-                        INSERT INTO welcome_config (guild_id, join_channel_id, join_title, join_enabled, join_duration)
-                        VALUES (?, ?, ?, ?, ?)
-                        ON CONFLICT(guild_id) DO UPDATE SET join_channel_id = ?, join_title = ?, join_enabled = ?, join_duration = ?
-                    """, (ctx.guild.id, channel_id, new_title, new_enable, new_duration, channel_id, new_title, new_enable, new_duration))
-                    await db.commit()
-                    await log.success(ctx, f"Join message config updated.")
+                    await log.client(ctx, "No join config found for this server.")
+                return
+
+            # Unset values keep their current value, or the default one for a new config
+            values = (channel.id if channel else None, title, enable, duration)
+            async with self._writer_lock:
+                db = self._writer
+                await db.execute("""
+                    INSERT INTO welcome_config (guild_id, join_channel_id, join_title, join_enabled, join_duration)
+                    VALUES (?, ?, COALESCE(?, 'Welcome'), COALESCE(?, 1), COALESCE(?, 0))
+                    ON CONFLICT(guild_id) DO UPDATE SET
+                        join_channel_id = COALESCE(?, welcome_config.join_channel_id),
+                        join_title = COALESCE(?, welcome_config.join_title),
+                        join_enabled = COALESCE(?, welcome_config.join_enabled),
+                        join_duration = COALESCE(?, welcome_config.join_duration)
+                """, (ctx.guild.id, *values, *values))
+                await db.commit()
+            self._invalidate_config(ctx.guild.id)
+            await log.success(ctx, f"Join message config updated.")
         except Exception as e:
             await log.failure(ctx, f"An error occurred while updating the database. Please try again later.\n```\n{e}\n```")
 
@@ -339,12 +587,14 @@ class Welcome(commands.Cog):
     @db_ready_only
     async def add_join_message(self, ctx: discord.Interaction, message: str) -> None:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._writer_lock:
+                db = self._writer
                 await db.execute("""
                     INSERT INTO welcome_join_messages (guild_id, message)
                     VALUES (?, ?)
                 """, (ctx.guild.id, message))
                 await db.commit()
+                self._invalidate_messages(self._join_msgs, ctx.guild.id)
                 await log.success(ctx, f"Join message added: {message}")
         except Exception as e:
             await log.failure(ctx, f"An error occurred while adding the join message. Please try again later.\n```\n{e}\n```")
@@ -353,13 +603,17 @@ class Welcome(commands.Cog):
     @db_ready_only
     async def remove_join_message(self, ctx: discord.Interaction, message_id: int) -> None:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                result = await db.execute("""
+            async with self._writer_lock:
+                db = self._writer
+                async with db.execute("""
                     DELETE FROM welcome_join_messages
                     WHERE id = ? AND guild_id = ?
-                """, (message_id, ctx.guild.id))
-                if result.rowcount > 0:
-                    await db.commit()
+                    RETURNING id
+                """, (message_id, ctx.guild.id)) as cursor:
+                    deleted = await cursor.fetchone()
+                await db.commit()
+                if deleted is not None:
+                    self._invalidate_messages(self._join_msgs, ctx.guild.id)
                     await log.success(ctx, f"Join message with ID {message_id} removed.")
                 else:
                     await log.failure(ctx, f"No join message found with ID {message_id}.")
@@ -368,21 +622,28 @@ class Welcome(commands.Cog):
 
     @joinGroup.command(name="list-message", description="List all join messages")
     @db_ready_only
-    async def list_join_messages(self, ctx: discord.Interaction) -> None:
+    async def list_join_messages(self, ctx: discord.Interaction, page: int = 1) -> None:
+        page = max(page, 1)
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute("""
-                    SELECT id, message FROM welcome_join_messages
-                    WHERE guild_id = ?
-                """, (ctx.guild.id,)) as cursor:
-                    messages = await cursor.fetchall()
+            db = await self._reader()
+            async with db.execute("""
+                SELECT id, message FROM welcome_join_messages
+                WHERE guild_id = ?
+                ORDER BY id
+                LIMIT ? OFFSET ?
+            """, (ctx.guild.id, LIST_PAGE_SIZE + 1, (page - 1) * LIST_PAGE_SIZE)) as cursor:
+                messages = await cursor.fetchall()
 
             if not messages:
-                await log.client(ctx, "No join messages configured for this server.")
+                if page > 1:
+                    await log.client(ctx, f"No join messages on page {page}.")
+                else:
+                    await log.client(ctx, "No join messages configured for this server.")
                 return
 
-            message_list = "\n".join([f"{msg[0]}: {msg[1]}" for msg in messages])
-            await log.client(ctx, f"Join messages:\n{message_list}")
+            has_next_page = len(messages) > LIST_PAGE_SIZE
+            message_list = "\n".join(f"{message_id}: {message}" for message_id, message in messages[:LIST_PAGE_SIZE])
+            await log.client(ctx, f"Join messages (page {page}):\n{message_list}" + (f"\nUse `page: {page + 1}` to see more." if has_next_page else ""))
         except Exception as e:
             await log.failure(ctx, f"An error occurred while listing join messages. Please try again later.\n```\n{e}\n```")
 
@@ -400,42 +661,31 @@ class Welcome(commands.Cog):
     @db_ready_only
     async def set_leave_config(self, ctx: discord.Interaction, channel: Optional[discord.TextChannel] = None, title: Optional[str] = None, enable: Optional[bool] = None, duration: Optional[int] = None) -> None:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute("""
-                    SELECT leave_channel_id, leave_title, leave_enabled, leave_duration FROM welcome_config
-                    WHERE guild_id = ?
-                """, (ctx.guild.id,)) as cursor:
-                    row = await cursor.fetchone()
-
-                if channel is None and title is None and enable is None and duration is None:
-                    if row:
-                        channel_id, title, enabled, leave_duration = row
-                        channel_mention = f"<#{channel_id}>" if channel_id else "None"
-                        await log.client(ctx, f"Current leave config: Channel: {channel_mention}, Title: {title}, Enabled: {enabled}, Duration: {leave_duration}s")
-                    else:
-                        await log.client(ctx, "No leave config found for this server.")
+            if channel is None and title is None and enable is None and duration is None:
+                row = await self._get_config(ctx.guild.id)
+                if row:
+                    channel_mention = f"<#{row['leave_channel_id']}>" if row["leave_channel_id"] else "None"
+                    await log.client(ctx, f"Current leave config: Channel: {channel_mention}, Title: {row['leave_title']}, Enabled: {row['leave_enabled']}, Duration: {row['leave_duration']}s")
                 else:
-                    # Get old values and update with new values
-                    if row:
-                        old_channel_id, old_title, old_enabled, old_duration = row
-                    else:
-                        old_channel_id = None
-                        old_title = "Goodbye"
-                        old_enabled = True
-                        old_duration = 0
-
-                    channel_id = channel.id if channel else old_channel_id
-                    new_title = title if title is not None else old_title
-                    new_enable = enable if enable is not None else old_enabled
-                    new_duration = duration if duration is not None else old_duration
-
-                    await db.execute("""
-                        INSERT INTO welcome_config (guild_id, leave_channel_id, leave_title, leave_enabled, leave_duration)
-                        VALUES (?, ?, ?, ?, ?)
-                        ON CONFLICT(guild_id) DO UPDATE SET leave_channel_id = ?, leave_title = ?, leave_enabled = ?, leave_duration = ?
-                    """, (ctx.guild.id, channel_id, new_title, new_enable, new_duration, channel_id, new_title, new_enable, new_duration))
-                    await db.commit()
-                    await log.success(ctx, f"Leave message config updated.")
+                    await log.client(ctx, "No leave config found for this server.")
+                return
+
+            # Unset values keep their current value, or the default one for a new config
+            values = (channel.id if channel else None, title, enable, duration)
+            async with self._writer_lock:
+                db = self._writer
+                await db.execute("""
+                    INSERT INTO welcome_config (guild_id, leave_channel_id, leave_title, leave_enabled, leave_duration)
+                    VALUES (?, ?, COALESCE(?, 'Goodbye'), COALESCE(?, 1), COALESCE(?, 0))
+                    ON CONFLICT(guild_id) DO UPDATE SET
+                        leave_channel_id = COALESCE(?, welcome_config.leave_channel_id),
+                        leave_title = COALESCE(?, welcome_config.leave_title),
+                        leave_enabled = COALESCE(?, welcome_config.leave_enabled),
+                        leave_duration = COALESCE(?, welcome_config.leave_duration)
+                """, (ctx.guild.id, *values, *values))
+                await db.commit()
+            self._invalidate_config(ctx.guild.id)
+            await log.success(ctx, f"Leave message config updated.")
         except Exception as e:
             await log.failure(ctx, f"An error occurred while updating the database. Please try again later.\n```\n{e}\n```")
 
@@ -443,12 +693,14 @@ class Welcome(commands.Cog):
     @db_ready_only
     async def add_leave_message(self, ctx: discord.Interaction, message: str) -> None:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._writer_lock:
+                db = self._writer
                 await db.execute("""
                     INSERT INTO welcome_leave_messages (guild_id, message)
                     VALUES (?, ?)
                 """, (ctx.guild.id, message))
                 await db.commit()
+                self._invalidate_messages(self._leave_msgs, ctx.guild.id)
                 await log.success(ctx, f"Leave message added: {message}")
         except Exception as e:
             await log.failure(ctx, f"An error occurred while adding the leave message. Please try again later.\n```\n{e}\n```")
@@ -457,13 +709,17 @@ class Welcome(commands.Cog):
     @db_ready_only
     async def remove_leave_message(self, ctx: discord.Interaction, message_id: int) -> None:
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                result = await db.execute("""
+            async with self._writer_lock:
+                db = self._writer
+                async with db.execute("""
                     DELETE FROM welcome_leave_messages
                     WHERE id = ? AND guild_id = ?
-                """, (message_id, ctx.guild.id))
-                if result.rowcount > 0:
-                    await db.commit()
+                    RETURNING id
+                """, (message_id, ctx.guild.id)) as cursor:
+                    deleted = await cursor.fetchone()
+                await db.commit()
+                if deleted is not None:
+                    self._invalidate_messages(self._leave_msgs, ctx.guild.id)
                     await log.success(ctx, f"Leave message with ID {message_id} removed.")
                 else:
                     await log.failure(ctx, f"No leave message found with ID {message_id}.")
@@ -472,21 +728,28 @@ class Welcome(commands.Cog):
 
     @leaveGroup.command(name="list-message", description="List all leave messages")
     @db_ready_only
-    async def list_leave_messages(self, ctx: discord.Interaction) -> None:
+    async def list_leave_messages(self, ctx: discord.Interaction, page: int = 1) -> None:
+        page = max(page, 1)
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute("""
-                    SELECT id, message FROM welcome_leave_messages
-                    WHERE guild_id = ?
-                """, (ctx.guild.id,)) as cursor:
-                    messages = await cursor.fetchall()
+            db = await self._reader()
+            async with db.execute("""
+                SELECT id, message FROM welcome_leave_messages
+                WHERE guild_id = ?
+                ORDER BY id
+                LIMIT ? OFFSET ?
+            """, (ctx.guild.id, LIST_PAGE_SIZE + 1, (page - 1) * LIST_PAGE_SIZE)) as cursor:
+                messages = await cursor.fetchall()
 
             if not messages:
-                await log.client(ctx, "No leave messages configured for this server.")
+                if page > 1:
+                    await log.client(ctx, f"No leave messages on page {page}.")
+                else:
+                    await log.client(ctx, "No leave messages configured for this server.")
                 return
 
-            message_list = "\n".join([f"{msg[0]}: {msg[1]}" for msg in messages])
-            await log.client(ctx, f"Leave messages:\n{message_list}")
+            has_next_page = len(messages) > LIST_PAGE_SIZE
+            message_list = "\n".join(f"{message_id}: {message}" for message_id, message in messages[:LIST_PAGE_SIZE])
+            await log.client(ctx, f"Leave messages (page {page}):\n{message_list}" + (f"\nUse `page: {page + 1}` to see more." if has_next_page else ""))
         except Exception as e:
             await log.failure(ctx, f"An error occurred while listing leave messages. Please try again later.\n```\n{e}\n```")
 
@@ -498,14 +761,15 @@ class Welcome(commands.Cog):
         await log.client(ctx, f"Testing leave message for member {target_member.mention}.")
 
 class WelcomeButton(discord.ui.Button):
-    def __init__(self, parent: Welcome, member: discord.Member):
+    def __init__(self, cog: Welcome, member: discord.Member):
         super().__init__(
             label="👋 Welcome!",
             style=discord.ButtonStyle.success
         )
-        self.parent = parent
+        self.cog = cog  # not "parent", a read-only property of discord.ui.Item
         self.member = member
-        self.greeters: list[int] = []
+        self.greeters: set[int] = set()
+        self._count: int = 0  # number of greeters
 
     async def callback(self, interaction: discord.Interaction):
         if interaction.user.id == self.member.id:
@@ -513,18 +777,20 @@ class WelcomeButton(discord.ui.Button):
             return
 
         # Check if already greeted
-        if interaction.user.id in self.greeters:
+        uid = interaction.user.id
+        if uid in self.greeters:
             await log.client(interaction, "You have already welcomed this member!")
             return
 
-        await self.parent.increment_greet_count(interaction.guild.id, interaction.user.id)
+        await self.cog.increment_greet_count(interaction.guild.id, uid)
 
         # Record the greeting
-        self.greeters.append(interaction.user.id)
-        
+        self.greeters.add(uid)
+        self._count += 1
+
         # Update the button label
-        self.label = f"👋 Welcome! ({len(self.greeters)} people welcomed you!)"
+        self.label = f"👋 Welcome! ({self._count} people welcomed you!)"
         await interaction.response.edit_message(view=self.view)
 
         # Dispatch the greeting event so that other modules can do some actions (eg. give xp)
-        self.parent.on_greeting.dispatch(interaction, self.member)
\ No newline at end of file
+        self.cog.on_greeting.dispatch(interaction, self.member)
\ No newline at end of file